@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sys, time, json, hashlib, logging, logging.handlers, sqlite3, smtplib, traceback, os, subprocess
+import sys, time, json, hashlib, logging, logging.handlers, sqlite3, smtplib, traceback, os, subprocess, re
+import concurrent.futures, mmap, collections, threading, shlex, atexit, mimetypes, random, socket, fcntl, signal
 from pathlib import Path
 from configparser import ConfigParser
 from email.mime.text import MIMEText
 from email.utils import formatdate
 
+import httplib2
+import google_auth_httplib2
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-from googleapiclient.http import MediaFileUpload
+from googleapiclient.http import MediaIoBaseUpload
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 
+# opzionale: BLAKE3 multi-thread per l'hash dei file
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
 SCOPES = [
     "https://www.googleapis.com/auth/youtube.upload",
     "https://www.googleapis.com/auth/youtube.readonly",
@@ -21,18 +30,120 @@ SCOPES = [
 # ======= PAUSA GLOBALE =========
 PAUSE_FLAG = Path("/volume2/TubeSync/.auth_paused")
 
+# Pausa quota: la scadenza è l'mtime di pause_file (il watcher la legge con un solo stat);
+# il contenuto è solo per chi fa "cat .pause_until".
+def read_pause_until(pf: Path) -> float:
+    try:
+        return os.stat(pf).st_mtime
+    except OSError:
+        return 0.0
+
+def set_pause_until(pf: Path, until: float):
+    pf.write_text(time.strftime("%F %T", time.localtime(until)) + "\n")
+    os.utime(pf, (until, until))
+
+def uploader_pidfile(db_path: Path) -> Path:
+    """Pid dell'uploader che sta scansionando: accanto a state.db (cartella già scrivibile)."""
+    return db_path.parent / ".uploader.pid"
+
+def daemon_socket_path(cfg: ConfigParser) -> str:
+    """daemon_socket o, se vuoto, .uploader.sock accanto a state.db (mai in /tmp, scrivibile da tutti)."""
+    raw = cfg.get("general", "daemon_socket", fallback="").strip()
+    if raw:
+        return str(Path(raw).expanduser())
+    return str(Path(cfg.get("general", "db_path", fallback="/volume2/TubeSync/state.db")).expanduser().parent
+               / ".uploader.sock")
+
+EXIT_BUSY = 75  # scansione saltata: un altro uploader ha il lock (il watcher rimanda il run)
+
+_PIDFILE_FD = {}  # pidfile -> fd aperto con flock: il lock vive finché il fd resta aperto
+
+def acquire_pidfile(pf: Path) -> bool:
+    """
+    flock esclusivo non bloccante su .uploader.pid: atomico (due uploader avviati insieme non
+    possono passare entrambi) e rilasciato dal kernel anche se il processo muore. False se un
+    altro uploader lo tiene; il pid scritto dentro serve solo al watcher e a chi guarda.
+    """
+    try:
+        fd = os.open(pf, os.O_RDWR | os.O_CREAT, 0o644)
+    except OSError as e:
+        # cartella mancante/sola lettura: si procede senza lock invece di morire
+        logging.warning(f"Pidfile non scrivibile ({pf}): {e}")
+        return True
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0)
+    os.write(fd, str(os.getpid()).encode())
+    _PIDFILE_FD[pf] = fd
+    return True
+
+def release_pidfile(pf: Path):
+    # niente unlink: chi avesse già aperto il file prenderebbe il lock su un inode orfano
+    fd = _PIDFILE_FD.pop(pf, None)
+    if fd is not None:
+        try:
+            os.ftruncate(fd, 0)
+        except OSError:
+            pass
+        os.close(fd)  # chiude e rilascia il flock
+
 # ======= Log Center helper (forma testata) =======
+class SynoLogger:
+    """
+    Una sola /bin/sh persistente: ogni log è una riga "synologset1 ..." scritta sul suo stdin.
+    Niente fork+exec del processo Python per ogni riga, e chi logga non attende synologset1.
+    """
+    LEVELS = {"info": 0, "warn": 1, "err": 2}
+
+    def __init__(self):
+        self.proc = None
+        self.lock = threading.Lock()
+        self.min_level = 0  # logcenter_min_level: sotto soglia solo syslog (/dev/log), niente synologset1
+
+    def set_min_level(self, cfg: ConfigParser):
+        self.min_level = self.LEVELS.get(cfg.get("general", "logcenter_min_level", fallback="info").strip().lower(), 0)
+
+    def log(self, level: str, eid_hex: str, msg: str):
+        if self.LEVELS.get(level, 2) < self.min_level:
+            return
+        text = shlex.quote(f"[TubeSync] {msg} - {time.strftime('%F %T')}")
+        line = f"/usr/syno/bin/synologset1 sys {level} {eid_hex} {text} >/dev/null 2>&1\n"
+        with self.lock:
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    # surrogateescape: nomi file non UTF-8 tornano ai byte originali
+                    self.proc = subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                                 stderr=subprocess.DEVNULL, text=True, errors="surrogateescape")
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+            except Exception:
+                self.proc = None  # un log fallito non deve mai interrompere l'upload
+
+    def close(self):
+        # EOF sullo stdin: la shell esegue le righe rimaste ed esce
+        with self.lock:
+            if self.proc is not None:
+                try:
+                    self.proc.stdin.close()
+                    self.proc.wait(timeout=10)
+                except Exception:
+                    pass
+                self.proc = None
+
+_syno = SynoLogger()
+atexit.register(_syno.close)
+
 def syno_log_info(eid_hex: str, msg: str):
-    cmd = f'/usr/syno/bin/synologset1 sys info {eid_hex} "[TubeSync] {msg} - $(date \'+%F %T\')"'
-    subprocess.run(["/bin/sh", "-c", cmd], check=False)
+    _syno.log("info", eid_hex, msg)
 
 def syno_log_warn(eid_hex: str, msg: str):
-    cmd = f'/usr/syno/bin/synologset1 sys warn {eid_hex} "[TubeSync] {msg} - $(date \'+%F %T\')"'
-    subprocess.run(["/bin/sh", "-c", cmd], check=False)
+    _syno.log("warn", eid_hex, msg)
 
 def syno_log_err(eid_hex: str, msg: str):
-    cmd = f'/usr/syno/bin/synologset1 sys err {eid_hex} "[TubeSync] {msg} - $(date \'+%F %T\')"'
-    subprocess.run(["/bin/sh", "-c", cmd], check=False)
+    _syno.log("err", eid_hex, msg)
 
 # ======= Logging console =======
 def setup_logging():
@@ -64,6 +175,10 @@ def load_config(cfg_path: Path) -> ConfigParser:
 def ensure_db(db_path: Path):
     db_path.parent.mkdir(parents=True, exist_ok=True)
     con = sqlite3.connect(str(db_path))
+    # WAL + synchronous=NORMAL: un solo fsync al checkpoint invece di due per ogni commit
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    con.execute("PRAGMA temp_store=MEMORY")
     con.execute("""
     CREATE TABLE IF NOT EXISTS uploads (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -79,43 +194,198 @@ def ensure_db(db_path: Path):
     )
     """)
     con.execute("CREATE INDEX IF NOT EXISTS idx_uploads_status ON uploads(status)")
+    # titoli già presenti sul canale (idratazione), persistiti tra un run e l'altro
+    con.execute("""
+    CREATE TABLE IF NOT EXISTS channel_videos (
+        title_key TEXT PRIMARY KEY,
+        video_id TEXT
+    )
+    """)
+    con.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)")
     con.commit()
     return con
 
-def sha1_of_file(p: Path, block=1024*1024):
-    h = hashlib.sha1()
-    with p.open("rb") as f:
-        while True:
-            chunk = f.read(block)
-            if not chunk:
-                break
-            h.update(chunk)
+# cache del daemon: config.ini riletto solo se cambia l'mtime, state.db aperto una volta
+_CFG = {}  # cfg_path -> (st_mtime_ns, ConfigParser)
+_CON = {}  # db_path -> sqlite3.Connection
+
+def cached_config(cfg_path: Path) -> ConfigParser:
+    try:
+        mtime = cfg_path.stat().st_mtime_ns
+    except OSError:
+        mtime = None
+    hit = _CFG.get(cfg_path)
+    if hit is None or (mtime is not None and hit[0] != mtime):
+        hit = _CFG[cfg_path] = (mtime, load_config(cfg_path))
+    return hit[1]
+
+def cached_db(db_path: Path):
+    con = _CON.get(db_path)
+    if con is None:
+        con = _CON[db_path] = ensure_db(db_path)
+    return con
+
+def _digest_mmap(f, new_hash, block=1024*1024):
+    h = new_hash()
+    size = os.fstat(f.fileno()).st_size
+    if size < block:
+        h.update(f.read())
+        return h.hexdigest()
+    try:
+        # una sola update() in C sul file mappato, senza loop Python per chunk
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                mm.madvise(mmap.MADV_SEQUENTIAL)
+            h.update(mm)
+        return h.hexdigest()
+    except (OSError, OverflowError, ValueError):
+        # es. file > spazio di indirizzamento su NAS ARM 32 bit: lettura a blocchi
+        h = new_hash()
+        f.seek(0)
+    while True:
+        chunk = f.read(block)
+        if not chunk:
+            break
+        h.update(chunk)
     return h.hexdigest()
 
-def is_allowed_ext(p: Path, allowed_exts):
-    return p.suffix.lower() in allowed_exts
+def _blake2b_160():
+    return hashlib.blake2b(digest_size=20)
+
+def file_hash(p: Path):
+    """
+    Hash per il solo rilevamento modifiche (non serve resistenza crittografica).
+    Prefisso con l'algoritmo ("b3:", "b2:") per distinguerlo dai vecchi SHA-1 senza prefisso.
+    """
+    if blake3 is not None:
+        h = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        h.update_mmap(str(p))
+        return "b3:" + h.hexdigest()
+    with p.open("rb") as f:
+        if hasattr(hashlib, "file_digest"):  # Python 3.11+: loop read/update interamente in C
+            return "b2:" + hashlib.file_digest(f, _blake2b_160).hexdigest()
+        return "b2:" + _digest_mmap(f, _blake2b_160)
+
+def _norm(s: str) -> str:
+    # chiave di confronto titoli (case-insensitive, Unicode-aware)
+    return s.strip().casefold()
+
+def parse_extensions(cfg: ConfigParser) -> frozenset:
+    # suffissi minuscoli col punto (".mp4"), come normalize_extensions del watcher: "mp4" non deve
+    # accettare anche "foo.xmp4"
+    return frozenset("." + e.strip().lower().lstrip(".")
+                     for e in cfg.get("general", "allowed_extensions", fallback="").split(",") if e.strip())
+
+def ext_matcher(allowed_exts):
+    # una sola regex compilata: il filtro sul nome gira in C, senza creare Path per file scartati
+    alts = "|".join(re.escape(e) for e in allowed_exts if e)
+    if not alts:
+        raise ValueError("allowed_extensions vuoto: nessun file da caricare")  # "(?:)$" accetterebbe tutto
+    return re.compile(rf"(?:{alts})$", re.IGNORECASE).search
+
+def _scan_tree(root: Path):
+    # walk iterativo con os.scandir: il tipo arriva da d_type, niente stat per le cartelle
+    stack = [str(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError as e:
+            logging.warning(f"Cartella non leggibile {d}: {e}")
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                elif entry.is_file():
+                    yield entry
 
 def discover_files(source_dirs, allowed_exts, min_size_bytes):
+    """Genera (Path, stat_result): lo stat della discovery viene riusato da main, senza rifarlo."""
+    match_ext = ext_matcher(allowed_exts)
+    seen = set()  # sorgenti annidate (es. Volo e Volo/Originali): ogni file una sola volta
     for s in source_dirs:
         root = Path(s).expanduser()
         if not root.exists():
             logging.warning(f"Cartella sorgente non trovata: {root}")
             syno_log_warn("0x11100061", f"Cartella sorgente non trovata: {root}")
             continue
-        for p in root.rglob("*"):
-            if p.is_file() and is_allowed_ext(p, allowed_exts):
-                try:
-                    size = p.stat().st_size
-                    if size < min_size_bytes:
-                        continue
-                    yield p
-                except Exception as e:
-                    logging.error(f"Stat fallita per {p}: {e}")
-                    syno_log_err("0x11100062", f"Stat fallita per {p}: {e}")
+        for entry in _scan_tree(root):
+            if not match_ext(entry.name) or entry.path in seen:
+                continue
+            seen.add(entry.path)
+            try:
+                st = entry.stat()
+                if st.st_size < min_size_bytes:
+                    continue
+                yield Path(entry.path), st
+            except Exception as e:
+                logging.error(f"Stat fallita per {entry.path}: {e}")
+                syno_log_err("0x11100062", f"Stat fallita per {entry.path}: {e}")
+
+def quick_unchanged(row, st) -> bool:
+    # quick-check alla rsync: stessa size e stesso mtime (al secondo) della riga in DB
+    _id, _status, old_size, old_mtime = row[:4]
+    return old_size == st.st_size and old_mtime is not None and int(old_mtime) == int(st.st_mtime)
+
+def prefetch_hashes(files, needs_hash, ahead=8):
+    """
+    Calcola gli hash in un pool di thread mentre il main thread carica:
+    l'hash del file N+1 si sovrappone all'upload del file N (hashlib/blake3 rilasciano il GIL).
+    Restituisce (path, stat, future|None) nello stesso ordine della discovery; al più 'ahead' in volo.
+    I thread del pool partono solo al primo submit: se nessun file va hashato non costa nulla.
+    """
+    workers = min(4, os.cpu_count() or 1)
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    pending = collections.deque()
+    try:
+        for p, st in files:
+            pending.append((p, st, pool.submit(file_hash, p) if needs_hash(p, st) else None))
+            if len(pending) >= ahead:
+                yield pending.popleft()
+        while pending:
+            yield pending.popleft()
+    finally:
+        # chiusura anticipata (break per quota): gli hash in coda si annullano invece di
+        # rileggere per intero file che non verranno caricati (come cancel_futures, anche su 3.8)
+        for _, _, fut in pending:
+            if fut is not None:
+                fut.cancel()
+        pool.shutdown(wait=False)
+
+def meta_get(con, key, default=None):
+    row = con.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+    return row[0] if row else default
+
+def meta_set(con, key, value):
+    con.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, str(value)))
+
+def db_load_all(con):
+    # una sola query all'avvio invece di una SELECT per file: path → (id, status, size, mtime, sha1, video_id)
+    cur = con.execute("SELECT path, id, status, size, mtime, sha1, video_id FROM uploads")
+    return {r[0]: r[1:] for r in cur}
+
+def db_insert(con, path: Path, size, mtime, sha1, status, video_id=None, error=None):
+    # path sicuramente nuovo (prima importazione): INSERT semplice, senza arbitro ON CONFLICT
+    now = time.time()
+    cur = con.execute("""
+        INSERT INTO uploads (path, size, mtime, sha1, status, video_id, error, created_at, updated_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (str(path), size, mtime, sha1, status, video_id, error, now, now))
+    return cur.lastrowid
 
-def db_get(con, path: Path):
-    cur = con.execute("SELECT id, status, size, mtime, sha1, video_id FROM uploads WHERE path = ?", (str(path),))
-    return cur.fetchone()
+def db_update(con, row_id, size, mtime, sha1, status, video_id=None, error=None):
+    con.execute("""
+        UPDATE uploads SET size=?, mtime=?, sha1=?, status=?, video_id=?, error=?, updated_at=?
+        WHERE id = ?
+    """, (size, mtime, sha1, status, video_id, error, time.time(), row_id))
+
+def db_save(con, row_id, path: Path, size, mtime, sha1, status, video_id=None, error=None):
+    """UPDATE se la riga esiste già (row_id noto), altrimenti INSERT. Restituisce l'id della riga."""
+    if row_id is None:
+        return db_insert(con, path, size, mtime, sha1, status, video_id, error)
+    db_update(con, row_id, size, mtime, sha1, status, video_id, error)
+    return row_id
 
 def db_upsert(con, path: Path, size, mtime, sha1, status, video_id=None, error=None):
     now = time.time()
@@ -127,7 +397,6 @@ def db_upsert(con, path: Path, size, mtime, sha1, status, video_id=None, error=N
             status=excluded.status, video_id=excluded.video_id, error=excluded.error,
             updated_at=excluded.updated_at
     """, (str(path), size, mtime, sha1, status, video_id, error, now, now))
-    con.commit()
 
 # ======= Email =======
 def send_email(cfg: ConfigParser, subject: str, body: str):
@@ -212,112 +481,135 @@ def get_authenticated_service(cfg: ConfigParser):
             logging.error(msg); syno_log_err("0x11100071", msg)
             raise RuntimeError(msg)
 
-    return build("youtube", "v3", credentials=creds, cache_discovery=False)
-
-def fetch_existing_titles(youtube):
-    titles = {}
+    # un solo client HTTP autorizzato: connessioni TLS riusate tra paginazione e chunk di upload.
+    # googleapiclient accetta solo oggetti con interfaccia httplib2: AuthorizedSession (requests/HTTP2) non è usabile.
+    authed = google_auth_httplib2.AuthorizedHttp(creds, http=httplib2.Http(timeout=60))
+    # documento di discovery incluso nel pacchetto: nessun fetch di rete all'avvio
+    return build("youtube", "v3", http=authed, cache_discovery=False, static_discovery=True)
+
+def fetch_existing_titles(youtube, con):
+    """
+    Riscrive channel_videos con i titoli dell'Uploads playlist del canale.
+    Tutto in una transazione (BEGIN IMMEDIATE: lock di scrittura preso subito, non a metà
+    paginazione): se la paginazione fallisce il chiamante fa rollback e resta l'elenco
+    del run precedente. Un executemany per pagina. Restituisce il numero di video.
+    """
     ch = youtube.channels().list(part="contentDetails", mine=True).execute()
     items = ch.get("items", [])
     if not items:
-        return titles
+        return 0
     uploads = items[0]["contentDetails"]["relatedPlaylists"]["uploads"]
+    if con.in_transaction:
+        con.commit()
+    con.execute("BEGIN IMMEDIATE")
+    con.execute("DELETE FROM channel_videos")
     page = None
     while True:
         resp = youtube.playlistItems().list(
             part="snippet,status", playlistId=uploads, maxResults=50, pageToken=page
         ).execute()
+        rows = []
         for it in resp.get("items", []):
             sn = it.get("snippet", {})
-            title = (sn.get("title") or "").strip().lower()
+            title = _norm(sn.get("title") or "")
             vid = (sn.get("resourceId", {}) or {}).get("videoId")
             if title and vid:
-                titles[title] = vid
+                rows.append((title, vid))
+        con.executemany("INSERT OR REPLACE INTO channel_videos (title_key, video_id) VALUES (?, ?)", rows)
         page = resp.get("nextPageToken")
         if not page:
             break
-    return titles
-
-def resumable_upload(youtube, file_path: Path, title: str, description: str, privacy: str,
-                     category_id: int, chunk_mb: int, max_retries: int):
-    body = {
-        "snippet": {
-            "title": title,
-            "description": description or "",
-            "categoryId": str(category_id) if category_id else None
-        },
-        "status": {"privacyStatus": privacy or "private"}
-    }
-    body["snippet"] = {k: v for k, v in body["snippet"].items() if v is not None}
-
-    media = MediaFileUpload(str(file_path), chunksize=chunk_mb * 1024 * 1024, resumable=True)
-    request = youtube.videos().insert(part="snippet,status", body=body, media_body=media)
-
-    response = None
-    retry = 0
-    backoff = 2
-
-    while response is None:
-        try:
-            status, response = request.next_chunk()
-            if status:
-                pct = int(status.progress() * 100)
-                logging.info(f"[{file_path.name}] Progresso upload: {pct}%")
-        except HttpError as e:
-            if e.resp.status in [500, 502, 503, 504] and retry < max_retries:
-                retry += 1
-                sleep_s = backoff ** retry
-                msg = f"[{file_path.name}] Errore {e.resp.status}, retry {retry}/{max_retries} tra {sleep_s}s"
-                logging.warning(msg)
-                syno_log_warn("0x11100080", msg)
-                time.sleep(sleep_s)
-                continue
-            raise
-        except Exception as e:
-            if retry < max_retries:
+    meta_set(con, "titles_fetched_at", time.time())
+    con.commit()
+    return con.execute("SELECT COUNT(*) FROM channel_videos").fetchone()[0]
+
+def find_video_by_title(con, title_key: str):
+    row = con.execute("SELECT video_id FROM channel_videos WHERE title_key = ?", (title_key,)).fetchone()
+    return row[0] if row else None
+
+def chunk_bytes(chunk_mb: int, file_size=None) -> int:
+    # chunk_mb <= 0 → file intero in una sola richiesta (chunksize=-1)
+    if chunk_mb <= 0:
+        return -1
+    if file_size is not None:
+        # chunk_mb_auto: circa 4 chunk per i file più piccoli di 4 × chunk_mb
+        chunk_mb = max(1, min(chunk_mb, file_size // (4 * 1024 * 1024)))
+    # MiB interi (getint): sempre multipli dei 256 KiB richiesti da YouTube
+    return chunk_mb * 1024 * 1024
+
+def build_body_template(description: str, privacy: str, category_id: int):
+    # costruito una volta sola da config; per ogni file cambia solo il titolo
+    snippet = {"description": description or ""}
+    if category_id:
+        snippet["categoryId"] = str(category_id)
+    return {"snippet": snippet, "status": {"privacyStatus": privacy or "private"}}
+
+# quotaExceeded (403) non è qui: è il limite giornaliero, ritentare spreca solo minuti per file.
+# Si propaga subito e run_once attiva la pausa quota.
+RETRY_REASONS_SLOW = (b"rateLimitExceeded", b"userRateLimitExceeded")
+
+def retry_cap(e: Exception):
+    """Tetto (s) del backoff per un errore ritentabile, None se l'errore va propagato."""
+    if not isinstance(e, HttpError):
+        return 60  # rete/timeout
+    if e.resp.status in (500, 502, 503, 504):
+        return 60
+    if b"quotaExceeded" in (e.content or b""):
+        return None
+    if e.resp.status == 429 or (e.resp.status == 403 and any(r in (e.content or b"") for r in RETRY_REASONS_SLOW)):
+        return 600
+    return None
+
+def resumable_upload(youtube, file_path: Path, title: str, body_template: dict,
+                     chunk_size: int, max_retries: int):
+    """Carica il file; restituisce (video_id, os.stat_result preso all'apertura del file)."""
+    body = {"snippet": {**body_template["snippet"], "title": title}, "status": body_template["status"]}
+
+    with open(file_path, "rb") as f:
+        st = os.fstat(f.fileno())  # stato del file davvero caricato (MediaIoBaseUpload fissa la size ora)
+        # lettura strettamente sequenziale: il kernel può fare read-ahead aggressivo sul NAS
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        media = MediaIoBaseUpload(f, mimetype=mimetypes.guess_type(file_path.name)[0] or "application/octet-stream",
+                                  chunksize=chunk_size, resumable=True)
+        request = youtube.videos().insert(part="snippet,status", body=body, media_body=media)
+
+        response = None
+        retry = 0
+
+        while response is None:
+            try:
+                status, response = request.next_chunk()
+                if status:
+                    pct = int(status.progress() * 100)
+                    logging.info(f"[{file_path.name}] Progresso upload: {pct}%")
+            except Exception as e:
+                cap = retry_cap(e)
+                if cap is None or retry >= max_retries:
+                    raise
                 retry += 1
-                sleep_s = backoff ** retry
-                msg = f"[{file_path.name}] Eccezione {type(e).__name__}: {e} — retry {retry}/{max_retries} tra {sleep_s}s"
+                # esponenziale scalato sul tetto (1s·2^n per rete/5xx, 10s·2^n per rate limit):
+                # entrambi raggiungono il proprio cap entro max_retries. Full jitter: retry di più
+                # processi/file non si allineano sugli stessi istanti
+                sleep_s = random.uniform(0, min(cap, cap / 60 * 2 ** retry))
+                if isinstance(e, HttpError):
+                    eid, what = "0x11100080", f"Errore {e.resp.status}"
+                else:
+                    eid, what = "0x11100081", f"Eccezione {type(e).__name__}: {e}"
+                msg = f"[{file_path.name}] {what} — retry {retry}/{max_retries} tra {sleep_s:.0f}s"
                 logging.warning(msg)
-                syno_log_warn("0x11100081", msg)
+                syno_log_warn(eid, msg)
                 time.sleep(sleep_s)
                 continue
-            raise
 
-        if response is not None:
-            if "id" in response:
-                return response["id"]
-            raise RuntimeError(f"Risposta inattesa API: {response}")
+            if response is not None:
+                if "id" in response:
+                    return response["id"], st
+                raise RuntimeError(f"Risposta inattesa API: {response}")
 
 # ======= Main =======
-def main():
-    setup_logging()
-
-    # Pausa globale: se presente, esco subito (silenzioso)
-    if PAUSE_FLAG.exists():
-        print("Auth in pausa: .auth_paused presente. Esco.")
-        return
-
-    cfg_path = Path(sys.argv[1]).expanduser() if len(sys.argv) > 1 else Path("/volume2/TubeSync/config.ini")
-    cfg = load_config(cfg_path)
-
-    dbp = Path(cfg.get("general", "db_path", fallback="/volume2/TubeSync/state.db")).expanduser()
-    con = ensure_db(dbp)
-
-    source_dirs = [s.strip() for s in cfg.get("general", "source_dirs").split(",") if s.strip()]
-    allowed_exts = [e.strip().lower() for e in cfg.get("general", "allowed_extensions").split(",")]
-    min_size_mb = cfg.getint("general", "skip_if_smaller_than_mb", fallback=5)
-    min_size_bytes = max(0, min_size_mb) * 1024 * 1024
-
-    privacy = cfg.get("general", "privacy", fallback="private")
-    category_id = cfg.getint("general", "category_id", fallback=22)
-    description = cfg.get("general", "description", fallback="")
-    use_sha1 = cfg.getboolean("general", "use_sha1", fallback=False)
-    chunk_mb = cfg.getint("general", "chunk_mb", fallback=8)
-    max_retries = cfg.getint("general", "max_retries", fallback=8)
-
-    hydrate = cfg.getboolean("general", "hydrate_from_youtube_on_start", fallback=True)
-    hydrate_match = cfg.get("general", "hydrate_match", fallback="exact_title").strip().lower()
-
+def authenticate(cfg: ConfigParser):
+    """Client YouTube autenticato; None se l'auth fallisce (crea la pausa globale e manda UNA email)."""
     subj_prefix = cfg.get("email", "subject_prefix", fallback="[TubeSync] ")
     to_email = cfg.get("email", "to_email", fallback=None)
 
@@ -326,6 +618,7 @@ def main():
     try:
         yt = get_authenticated_service(cfg)
         syno_log_info("0x11100071", "Autenticazione YouTube OK")
+        return yt
     except Exception as e:
         err = f"Autenticazione YouTube fallita: {e}"
         logging.error(err)
@@ -359,58 +652,133 @@ def main():
             except Exception:
                 pass
 
-        sys.exit(2)
+        return None
 
-    existing_title_map = {}
-    if hydrate:
+def run_once(cfg: ConfigParser, yt, con):
+    """Una scansione completa delle sorgenti; restituisce il riepilogo."""
+    source_dirs = [s.strip() for s in cfg.get("general", "source_dirs").split(",") if s.strip()]
+    allowed_exts = parse_extensions(cfg)
+    min_size_mb = cfg.getint("general", "skip_if_smaller_than_mb", fallback=5)
+    min_size_bytes = max(0, min_size_mb) * 1024 * 1024
+
+    privacy = cfg.get("general", "privacy", fallback="private")
+    category_id = cfg.getint("general", "category_id", fallback=22)
+    description = cfg.get("general", "description", fallback="")
+    use_sha1 = cfg.getboolean("general", "use_sha1", fallback=False)
+    chunk_mb = cfg.getint("general", "chunk_mb", fallback=64)
+    chunk_mb_auto = cfg.getboolean("general", "chunk_mb_auto", fallback=False)
+    max_retries = cfg.getint("general", "max_retries", fallback=8)
+    body_template = build_body_template(description, privacy, category_id)
+
+    hydrate = cfg.getboolean("general", "hydrate_from_youtube_on_start", fallback=True)
+    hydrate_match = cfg.get("general", "hydrate_match", fallback="exact_title").strip().lower()
+    hydrate_cache_seconds = cfg.getint("general", "hydrate_cache_seconds", fallback=3600)
+
+    subj_prefix = cfg.get("email", "subject_prefix", fallback="[TubeSync] ")
+    pause_file = Path(cfg.get("general", "pause_file", fallback="/volume2/TubeSync/.pause_until")).expanduser()
+    quota_cooldown_minutes = cfg.getint("general", "quota_cooldown_minutes", fallback=1440)
+
+    pause_until = read_pause_until(pause_file)
+    if pause_until > time.time():
+        msg = f"Pausa quota attiva fino a {time.strftime('%F %T', time.localtime(pause_until))}: scansione saltata."
+        logging.info(msg)
+        return msg
+    if pause_until:
+        # pausa scaduta: via il file, così watcher e "cat .pause_until" vedono subito "nessuna pausa"
+        try:
+            pause_file.unlink()
+        except FileNotFoundError:
+            pass
+        logging.info("Pausa quota scaduta: riprendo gli upload.")
+
+    titles_age = time.time() - float(meta_get(con, "titles_fetched_at", 0))
+    if hydrate and titles_age < hydrate_cache_seconds:
+        n = con.execute("SELECT COUNT(*) FROM channel_videos").fetchone()[0]
+        logging.info(f"Idratazione da cache (state.db, {int(titles_age)}s fa): {n} video.")
+        syno_log_info("0x11100073", f"Idratazione da cache: {n} video.")
+    elif hydrate:
         logging.info("Idratazione: scarico elenco titoli dal canale (Uploads)...")
         syno_log_info("0x11100072", "Idratazione: scarico elenco titoli (Uploads)")
         try:
-            existing_title_map = fetch_existing_titles(yt)
-            logging.info(f"Idratazione completata: {len(existing_title_map)} video trovati.")
-            syno_log_info("0x11100073", f"Idratazione completata: {len(existing_title_map)} video trovati.")
+            n = fetch_existing_titles(yt, con)
+            logging.info(f"Idratazione completata: {n} video trovati.")
+            syno_log_info("0x11100073", f"Idratazione completata: {n} video trovati.")
         except Exception as e:
+            con.rollback()
             logging.warning(f"Idratazione fallita (procedo): {e}")
             syno_log_warn("0x11100076", f"Idratazione fallita (procedo): {e}")
 
+    # invii email in background: l'upload successivo non attende il round-trip SMTP/API
+    mail_pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    known_rows = db_load_all(con)
     count_total = count_done = count_skipped = count_errors = count_marked_done = 0
-
-    for p in discover_files(source_dirs, allowed_exts, min_size_bytes):
+    quota_hit = False
+
+    def needs_hash(p, st):
+        # file già caricato con (size, mtime) invariati: l'hash non serve, si evita di rileggerlo
+        if not use_sha1:
+            return False
+        row = known_rows.get(str(p))
+        return not (row and row[1] == "done" and quick_unchanged(row, st))
+
+    scan_started_at = time.time()
+    files = discover_files(source_dirs, allowed_exts, min_size_bytes)
+    hashed_files = prefetch_hashes(files, needs_hash)
+    for p, st, hashed in hashed_files:
         count_total += 1
+        if count_total % 100 == 0:  # marcature da idratazione committate a blocchi
+            con.commit()
         try:
-            st = p.stat()
             size, mtime = st.st_size, st.st_mtime
-            sha1 = sha1_of_file(p) if use_sha1 else None
             title = p.stem
-            title_key = title.strip().lower()
+            title_key = _norm(title)
 
-            row = db_get(con, p)
+            row = known_rows.get(str(p))
+            row_id = None
             if row:
-                _id, status, old_size, old_mtime, old_sha1, video_id = row
-                unchanged = (old_size == size and int(old_mtime) == int(mtime) and (not use_sha1 or old_sha1 == sha1))
-                if status == "done" and unchanged:
+                row_id, status = row[0], row[1]
+                if status == "done" and quick_unchanged(row, st):
                     count_skipped += 1
                     continue
+            sha1 = hashed.result() if hashed else None
+            if row and row[1] == "done" and sha1 and sha1 == row[4]:
+                # size/mtime cambiati (touch, copia, restore) ma contenuto identico: si aggiorna la riga
+                db_update(con, row_id, size, mtime, sha1, "done", row[5], None)
+                count_skipped += 1
+                logging.info(f"[{p.name}] mtime/size cambiati ma hash invariato → nessun nuovo upload.")
+                continue
 
             if hydrate and hydrate_match == "exact_title":
-                found_vid = existing_title_map.get(title_key)
+                found_vid = find_video_by_title(con, title_key)
                 if found_vid:
-                    db_upsert(con, p, size, mtime, sha1, "done", found_vid, None)
+                    db_save(con, row_id, p, size, mtime, sha1, "done", found_vid, None)
                     count_marked_done += 1
                     logging.info(f"[{p.name}] Già presente su YouTube (ID: {found_vid}) → marcato done.")
                     syno_log_info("0x11100077", f"{p.name} già su YouTube (ID {found_vid}) → marcato done")
                     continue
 
-            db_upsert(con, p, size, mtime, sha1, "pending", None, None)
-            video_id = resumable_upload(yt, p, title, description, privacy, category_id, chunk_mb, max_retries)
-            db_upsert(con, p, size, mtime, sha1, "done", video_id, None)
+            row_id = db_save(con, row_id, p, size, mtime, sha1, "pending", None, None)
+            con.commit()
+            chunk_size = chunk_bytes(chunk_mb, size if chunk_mb_auto else None)
+            video_id, cur = resumable_upload(yt, p, title, body_template, chunk_size, max_retries)
+            if (cur.st_size, cur.st_mtime) != (size, mtime):
+                # stat/hash della discovery presi fino a 'ahead' upload prima (file magari ancora in
+                # scrittura): in DB va lo stato del file caricato davvero, letto all'apertura
+                size, mtime = cur.st_size, cur.st_mtime
+                sha1 = file_hash(p) if use_sha1 else None
+            db_update(con, row_id, size, mtime, sha1, "done", video_id, None)
+            # titolo subito in channel_videos: la cache di idratazione (hydrate_cache_seconds) non lo
+            # conterrebbe fino al prossimo refresh → niente doppio upload se il file cambia prima
+            con.execute("INSERT OR REPLACE INTO channel_videos (title_key, video_id) VALUES (?, ?)",
+                        (title_key, video_id))
+            con.commit()  # un upload riuscito non deve mai andare perso
             count_done += 1
 
             link = f"https://youtu.be/{video_id}"
             logging.info(f"[{p.name}] COMPLETATO: {link}")
             syno_log_info("0x11100078", f"{p.name} COMPLETATO: {link}")
-            send_email(cfg, f"{subj_prefix} OK — {p.name}",
-                       f"Caricamento completato.\n\nFile: {p}\nTitolo: {title}\nVideo ID: {video_id}\nLink: {link}\n")
+            mail_pool.submit(send_email, cfg, f"{subj_prefix} OK — {p.name}",
+                             f"Caricamento completato.\n\nFile: {p}\nTitolo: {title}\nVideo ID: {video_id}\nLink: {link}\n")
 
         except Exception as e:
             count_errors += 1
@@ -425,12 +793,31 @@ def main():
             sha1 = None
             if use_sha1 and p.exists():
                 try:
-                    sha1 = sha1_of_file(p)
+                    sha1 = file_hash(p)
                 except Exception:
                     pass
             db_upsert(con, p, size, mtime, sha1, "error", None, str(e))
-            send_email(cfg, f"{subj_prefix} ERROR — {p.name}",
-                       f"Caricamento FALLITO.\n\nFile: {p}\n\nErrore: {e}\n\nTraceback:\n{traceback.format_exc()}")
+            con.commit()
+            mail_pool.submit(send_email, cfg, f"{subj_prefix} ERROR — {p.name}",
+                             f"Caricamento FALLITO.\n\nFile: {p}\n\nErrore: {e}\n\nTraceback:\n{traceback.format_exc()}")
+            if isinstance(e, HttpError) and b"quotaExceeded" in (e.content or b""):
+                # quota giornaliera finita (mai ritentata): gli altri file fallirebbero uguale
+                msg = f"Quota YouTube esaurita: pausa di {quota_cooldown_minutes} min ({pause_file})"
+                try:
+                    set_pause_until(pause_file, time.time() + quota_cooldown_minutes * 60)
+                except OSError as pe:
+                    # run comunque interrotto qui; le mail in coda partono, il watcher non vede la pausa
+                    msg = f"Quota YouTube esaurita, ma pause_file non scrivibile ({pause_file}): {pe}"
+                logging.warning(msg)
+                syno_log_warn("0x11100082", msg)
+                quota_hit = True
+                break
+    hashed_files.close()  # subito, non al garbage collect: annulla gli hash rimasti in coda
+
+    if not quota_hit:
+        # letto dal watcher all'avvio: se nessun file è più recente, la scansione iniziale si salta
+        meta_set(con, "last_scan_started_at", scan_started_at)
+    con.commit()
 
     summary = (f"Totale trovati: {count_total}, Caricati ora: {count_done}, "
                f"Segnati già presenti: {count_marked_done}, Skippati invariati: {count_skipped}, Errori: {count_errors}")
@@ -440,7 +827,123 @@ def main():
     to_email = cfg.get("email", "to_email", fallback=None)
     if to_email and cfg.getboolean("email", "send_summary", fallback=True):
         if cfg.getboolean("email", "send_summary_when_noop", fallback=False) or any([count_done, count_marked_done, count_errors]):
-            send_email(cfg, f"{cfg.get('email','subject_prefix',fallback='[TubeSync] ')} Summary", summary)
+            mail_pool.submit(send_email, cfg, f"{cfg.get('email','subject_prefix',fallback='[TubeSync] ')} Summary", summary)
+    mail_pool.shutdown(wait=True)
+    return summary
+
+def serve(cfg_path: Path):
+    """
+    Modalità --daemon: processo residente che tiene client YouTube (token, discovery,
+    keep-alive) e connessione SQLite tra un run e l'altro. Il watcher si connette al
+    socket Unix, scrive "scan" e attende la risposta "<exit code> <messaggio>".
+    Una richiesta alla volta: mai due scansioni in parallelo.
+    """
+    cfg = cached_config(cfg_path)
+    _syno.set_min_level(cfg)
+    if not parse_extensions(cfg):
+        logging.error("allowed_extensions mancante o vuoto in [general]")
+        sys.exit(2)
+    sock_path = daemon_socket_path(cfg)
+    try:
+        os.unlink(sock_path)  # socket rimasto da un daemon precedente
+    except FileNotFoundError:
+        pass
+    srv = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)  # 0600 già alla creazione: nessuna finestra prima del chmod
+    try:
+        srv.bind(sock_path)
+    finally:
+        os.umask(old_umask)
+    srv.listen(4)
+
+    def _unlink_socket():
+        try:
+            os.unlink(sock_path)
+        except OSError:
+            pass
+    atexit.register(_unlink_socket)
+
+    def _stop(signum, _frame):
+        # kill / stop DSM / stop_daemon del watcher: SystemExit fa girare finally e atexit (socket,
+        # pidfile, shell Log Center). Solo logging qui: il lock di SynoLogger potrebbe essere preso
+        logging.info(f"Daemon uploader: stop (segnale {signal.Signals(signum).name})")
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, _stop)
+    logging.info(f"Daemon uploader in ascolto su {sock_path}")
+    syno_log_info("0x1110007B", f"Daemon uploader in ascolto su {sock_path}")
+
+    yt = yt_cfg = con = None
+    while True:
+        conn, _ = srv.accept()
+        with conn:
+            conn.settimeout(10)
+            try:
+                req = conn.makefile("rb").readline().strip()
+            except OSError:
+                continue
+            conn.settimeout(None)
+            if req != b"scan":
+                reply = f"1 comando sconosciuto: {req[:40]!r}"
+            elif PAUSE_FLAG.exists():
+                reply = "0 auth in pausa (.auth_paused): scansione saltata"
+            else:
+                try:
+                    cfg = cached_config(cfg_path)
+                    _syno.set_min_level(cfg)
+                    dbp = Path(cfg.get("general", "db_path", fallback="/volume2/TubeSync/state.db")).expanduser()
+                    con = cached_db(dbp)
+                    pidfile = uploader_pidfile(dbp)
+                    if yt is None or yt_cfg is not cfg:  # config cambiato: credenziali/token possono essere altri
+                        yt, yt_cfg = authenticate(cfg), cfg
+                    if yt is None:
+                        reply = "2 autenticazione fallita"
+                    elif not acquire_pidfile(pidfile):
+                        reply = f"{EXIT_BUSY} un altro uploader è in esecuzione: scansione saltata"
+                    else:
+                        try:
+                            reply = f"0 {run_once(cfg, yt, con)}"
+                        finally:
+                            release_pidfile(pidfile)
+                except Exception as e:
+                    if con is not None:
+                        con.rollback()
+                    logging.error(f"Scansione fallita: {e}")
+                    logging.error(traceback.format_exc())
+                    reply = f"1 {e}"
+            try:
+                conn.sendall((" ".join(reply.split()) + "\n").encode())
+            except OSError:
+                pass
+
+def main():
+    setup_logging()
+    args = [a for a in sys.argv[1:] if a != "--daemon"]
+    cfg_path = Path(args[0]).expanduser() if args else Path("/volume2/TubeSync/config.ini")
+    if "--daemon" in sys.argv[1:]:
+        serve(cfg_path)
+        return
+
+    # Pausa globale: se presente, esco subito (silenzioso)
+    if PAUSE_FLAG.exists():
+        print("Auth in pausa: .auth_paused presente. Esco.")
+        return
+
+    cfg = load_config(cfg_path)
+    _syno.set_min_level(cfg)
+    if not parse_extensions(cfg):
+        logging.error("allowed_extensions mancante o vuoto in [general]")
+        sys.exit(2)
+    dbp = Path(cfg.get("general", "db_path", fallback="/volume2/TubeSync/state.db")).expanduser()
+    con = ensure_db(dbp)  # crea anche la cartella di state.db, dove sta il pidfile
+    pidfile = uploader_pidfile(dbp)
+    if not acquire_pidfile(pidfile):
+        print(f"Uploader già in esecuzione ({pidfile}). Esco.")
+        sys.exit(EXIT_BUSY)
+    atexit.register(release_pidfile, pidfile)
+    yt = authenticate(cfg)
+    if yt is None:
+        sys.exit(2)
+    run_once(cfg, yt, con)
 
 if __name__ == "__main__":
     main()
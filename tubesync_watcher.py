@@ -1,55 +1,155 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
-import sys, time, threading, subprocess, logging, logging.handlers, os
+import sys, time, threading, subprocess, logging, logging.handlers, os, sqlite3, socket, signal, atexit, shlex
+import ctypes, errno, select, struct
 from pathlib import Path
 from configparser import ConfigParser
 from watchdog.observers import Observer
-from watchdog.events import PatternMatchingEventHandler
+from watchdog.observers.polling import PollingObserver
+from watchdog.events import FileSystemEventHandler
 
 # ======= PAUSA GLOBALE =========
 PAUSE_FLAG = Path("/volume2/TubeSync/.auth_paused")
 
+def read_pause_until(pf: Path) -> float:
+    """Scadenza della pausa quota = mtime di pause_file (un solo stat, niente open/read/parse); 0 se assente."""
+    try:
+        return os.stat(pf).st_mtime
+    except OSError:
+        return 0.0
+
+EXIT_BUSY = 75  # exit code/risposta dell'uploader che ha trovato il lock preso: run da rimandare
+
+def uploader_is_running(pidfile) -> bool:
+    """
+    Uploader avviato fuori dal watcher (es. a mano)? .uploader.pid accanto a state.db + os.kill(pid, 0),
+    senza fork. Pid riusato dopo crash/reboot: conta solo se /proc/<pid>/cmdline è tubesync_synology.py.
+    """
+    if pidfile is None:
+        return False
+    try:
+        pid = int(Path(pidfile).read_text())
+        if pid == os.getpid():
+            return False
+        os.kill(pid, 0)
+    except PermissionError:
+        pass  # esiste ma di un altro utente: vivo (poi il controllo su cmdline)
+    except (OSError, ValueError):
+        return False  # pidfile assente/vuoto/illeggibile o processo terminato
+    try:
+        return b"tubesync_synology.py" in Path(f"/proc/{pid}/cmdline").read_bytes()
+    except FileNotFoundError:
+        return False
+    except OSError:
+        return True  # niente /proc (es. macOS): basta kill
+
 # ======= Log Center helper (FORZA eventID noto + fallback logger) =======
 FIXED_EID = "0x11100000"  # EventID noto che vedi in Log Center (System)
 
-def _syno_log(level: str, msg: str):
+class SynoLogger:
     """
-    Prova a loggare in Log Center (System) usando synologset1 con un eventID noto e accettato.
-    In caso di errore, fa fallback su /usr/bin/logger -p user.INFO (così almeno qualcosa resta).
+    Una sola /bin/sh persistente (come nell'uploader): ogni log è una riga scritta sul suo stdin,
+    niente fork+exec per riga. synologset1 → System; se fallisce, fallback su /usr/bin/logger
+    (user.*) così almeno qualcosa resta. Gli errori del fallback finiscono sullo stderr del watcher.
     """
-    logger = logging.getLogger("TubeSyncWatcher")
+    LEVELS = {"info": 0, "warn": 1, "err": 2}
+
+    def __init__(self):
+        self.proc = None
+        self.lock = threading.Lock()
+        self.min_level = 0  # logcenter_min_level: sotto soglia solo syslog (/dev/log), niente synologset1
+        self.max_info = 0   # logcenter_max_info_per_minute: 0 = nessun limite
+        self._window = 0.0  # monotonic di inizio del minuto corrente
+        self._info_sent = 0
+        self._info_dropped = 0
+        self._ts_sec, self._ts_str = 0, ""  # timestamp Log Center già formattato per il secondo corrente
 
-    # 1) synologset1 → System
-    cmd_sys = f'/usr/syno/bin/synologset1 sys {level} {FIXED_EID} "[TubeSync] {msg} - $(date \'+%F %T\')"'
-    cp = subprocess.run(["/bin/sh", "-c", cmd_sys], capture_output=True, text=True)
+    def set_min_level(self, cfg: ConfigParser):
+        self.min_level = self.LEVELS.get(cfg.get("general", "logcenter_min_level", fallback="info").strip().lower(), 0)
+        self.max_info = max(0, cfg.getint("general", "logcenter_max_info_per_minute", fallback=30))
+
+    def log(self, level: str, msg: str):
+        if self.LEVELS.get(level, 2) < self.min_level:
+            return
+        if level == "info" and self.max_info:
+            # raffica di info (es. tante finestre brevi): oltre max_info al minuto solo syslog;
+            # warn/err passano sempre. Il conteggio dei saltati arriva col primo info del minuto dopo.
+            with self.lock:
+                now = time.monotonic()
+                dropped = 0
+                if now - self._window >= 60:
+                    dropped, self._info_dropped = self._info_dropped, 0
+                    self._window, self._info_sent = now, (1 if dropped else 0)
+                if self._info_sent >= self.max_info:
+                    self._info_dropped += 1
+                    return
+                self._info_sent += 1
+            if dropped:
+                self._write("info", f"{dropped} messaggi info non inviati a Log Center "
+                                    f"(limite {self.max_info}/min, dettagli nel syslog)")
+        self._write(level, msg)
 
-    if cp.returncode == 0:
-        return  # ok, visibile in Log Center → System
+    def _write(self, level: str, msg: str):
+        pri = "user.info" if level == "info" else ("user.warn" if level == "warn" else "user.err")
+        now = int(time.time())
+        if now != self._ts_sec:  # strftime solo quando cambia il secondo
+            self._ts_sec, self._ts_str = now, time.strftime("%F %T", time.localtime(now))
+        text = shlex.quote(f"[TubeSync] {msg} - {self._ts_str}")
+        line = (f"/usr/syno/bin/synologset1 sys {level} {FIXED_EID} {text} >/dev/null 2>&1"
+                f" || /usr/bin/logger -t TubeSync -p {pri} {shlex.quote(f'[TubeSync] {msg}')}\n")
+        with self.lock:
+            try:
+                if self.proc is None or self.proc.poll() is not None:
+                    # surrogateescape: nomi file non UTF-8 (os.fsdecode) tornano ai byte originali
+                    self.proc = subprocess.Popen(["/bin/sh"], stdin=subprocess.PIPE, stdout=subprocess.DEVNULL,
+                                                 text=True, errors="surrogateescape")
+                self.proc.stdin.write(line)
+                self.proc.stdin.flush()
+            except Exception as e:
+                # un log fallito non deve mai propagarsi (scheduler, worker, thread inotify)
+                self.proc = None
+                logging.getLogger("TubeSyncWatcher").warning(f"Log Center non raggiungibile: {e!r}")
 
-    # 2) fallback: /usr/bin/logger (user.info)
-    #   Nota: Log Center di default non sempre mostra user.*, ma almeno non perdiamo il messaggio
-    pri = "user.info" if level == "info" else ("user.warn" if level == "warn" else "user.err")
-    cmd_logger = f'/usr/bin/logger -t TubeSync -p {pri} "[TubeSync] {msg}"'
-    cp2 = subprocess.run(["/bin/sh", "-c", cmd_logger], capture_output=True, text=True)
+    def close(self):
+        # EOF sullo stdin: la shell esegue le righe rimaste ed esce
+        with self.lock:
+            if self.proc is not None:
+                try:
+                    self.proc.stdin.close()
+                    self.proc.wait(timeout=10)
+                except Exception:
+                    pass
+                self.proc = None
 
-    # Traccia in console i fallimenti (così capiamo se e perché non si vede)
-    if cp.returncode != 0:
-        logger.warning(f"synologset1 FAILED rc={cp.returncode} level={level} eid={FIXED_EID} "
-                       f"stderr={cp.stderr.strip()} cmd={cmd_sys}")
-    if cp2.returncode != 0:
-        logger.warning(f"logger fallback FAILED rc={cp2.returncode} level={level} cmd={cmd_logger} "
-                       f"stderr={cp2.stderr.strip()}")
+_syno = SynoLogger()
+atexit.register(_syno.close)
+
+def _syno_log(level: str, msg: str):
+    _syno.log(level, msg)
 
 def syno_log_info(msg: str): _syno_log("info", msg)
 def syno_log_warn(msg: str): _syno_log("warn", msg)
 def syno_log_err(msg: str):  _syno_log("err",  msg)
 
 # ======= Logging console (/dev/log se disponibile) =======
+class _PrefixFormatter(logging.Formatter):
+    """"%(name)s[%(process)d]: %(message)s" con il prefisso calcolato una volta per logger, non per record."""
+    def __init__(self):
+        super().__init__("%(name)s[%(process)d]: %(message)s")
+        self._prefixes = {}
+    def format(self, record):
+        if record.exc_info or record.exc_text or record.stack_info:
+            return super().format(record)  # traceback: formattazione standard
+        prefix = self._prefixes.get(record.name)
+        if prefix is None:
+            prefix = self._prefixes[record.name] = f"{record.name}[{record.process}]: "
+        return prefix + record.getMessage()
+
 def setup_logging():
     for h in logging.root.handlers[:]:
         logging.root.removeHandler(h)
-    fmt = logging.Formatter("%(name)s[%(process)d]: %(message)s")
+    fmt = _PrefixFormatter()
     handlers = [logging.StreamHandler()]
     handlers[0].setFormatter(fmt)
     try:
@@ -64,106 +164,509 @@ def setup_logging():
     return logging.getLogger("TubeSyncWatcher")
 
 # ======= Runner con debounce =======
+MAX_WINDOW_PATHS = 50_000  # file tracciati per finestra: oltre, import enormi non fanno crescere la memoria
+WINDOW_INFO_FILES = 20     # file nuovi per finestra loggati a INFO; gli altri a DEBUG, il totale nel riepilogo
 class DebouncedRunner:
     def __init__(self, logger, cmd, debounce_seconds, settle_seconds, max_debounce_seconds,
-                 rescan_minutes, event_log_interval_seconds):
+                 rescan_minutes, event_log_interval_seconds, sock_path=None, pause_check_seconds=30,
+                 pause_file=None, work_waiting=None, uploader_pidfile=None):
         self.log = logger
         self.cmd = cmd
+        self._cmd_str = " ".join(cmd)  # per i log di ogni run
+        self.sock_path = sock_path  # daemon uploader (--daemon); se non risponde → subprocess
+        self._daemon = None         # daemon uploader lanciato dal watcher (uploader_daemon = true)
         self.debounce = debounce_seconds
         self.settle = settle_seconds
         self.max_debounce = max_debounce_seconds
         self.rescan_minutes = rescan_minutes
         self.event_log_interval_seconds = event_log_interval_seconds
-        self._timer = None
+        self.pause_check = max(1, int(pause_check_seconds or 30))
+        self.pause_file = pause_file
+        self.work_waiting = work_waiting  # callable: False → il rescan periodico non lancia l'uploader
+        self.uploader_pidfile = uploader_pidfile  # .uploader.pid dell'uploader (accanto a state.db)
+        self._paused = self.pause_active()  # aggiornato dallo scheduler: niente stat() per ogni evento
+        self._wake_at = None     # monotonic della prossima valutazione del debounce (None = niente in attesa)
         self._first_event_ts = None
         self._last_event_ts = None
+        self._path_last_ts = {}  # ultimo evento per file nella finestra di debounce corrente
+        self._open_paths = set() # file scritti e non ancora chiusi (IN_CLOSE_WRITE non ancora visto)
+        self._overflow = False   # finestra oltre MAX_WINDOW_PATHS: file extra non tracciati singolarmente
+        self.close_events = False  # observer con IN_CLOSE_WRITE: si aspetta la chiusura, non il silenzio
+        self._running = False    # uploader in esecuzione (mai due istanze insieme)
+        self._rescanning = False # walk del rescan periodico in corso (thread a parte)
+        self._pending = False    # richiesto un altro run mentre l'uploader girava
         self._lock = threading.Lock()
-        threading.Thread(target=self._rescan_loop, daemon=True).start()
-        threading.Thread(target=self._activity_loop, daemon=True).start()
+        self._cv = threading.Condition(self._lock)
+        threading.Thread(target=self._scheduler_loop, daemon=True).start()
 
-    def trigger(self):
-        if PAUSE_FLAG.exists():
-            self.log.info("Pausa attiva (.auth_paused): evento ignorato.")
-            return
-        now = time.time()
+    def trigger(self, path=None, closed=False):
+        """
+        Registra un evento; True se è il primo evento per 'path' nella finestra di debounce
+        ed entro i primi WINDOW_INFO_FILES file della finestra (→ log a INFO).
+        closed=True: il writer ha chiuso il file (inotify IN_CLOSE_WRITE). Se nella finestra
+        non restano file aperti, la valutazione arriva dopo settle invece che dopo debounce.
+        """
+        if self._paused:
+            self.log.debug("Pausa attiva: evento ignorato.")
+            return False
+        now = time.monotonic()
         with self._lock:
+            prev = self._path_last_ts.get(path)
+            tracked = prev is not None or len(self._path_last_ts) < MAX_WINDOW_PATHS
+            if tracked:
+                self._path_last_ts[path] = now
+                if closed:
+                    self._open_paths.discard(path)
+                elif path is not None:
+                    self._open_paths.add(path)
+            else:
+                self._overflow = True  # conta solo per timestamp/debounce; chiusure non più affidabili
             if self._first_event_ts is None:
                 self._first_event_ts = now
             self._last_event_ts = now
-            if self._timer:
-                self._timer.cancel()
-            self._timer = threading.Timer(self.debounce, self._maybe_run)
-            self._timer.daemon = True
-            self._timer.start()
+            all_closed = closed and not self._open_paths and not self._overflow
+            # niente thread per evento: si sposta solo la scadenza, lo scheduler se ne accorge al risveglio
+            if self._wake_at is None or all_closed:
+                self._cv.notify()
+            self._wake_at = now + (self.settle if all_closed else self.debounce)
+            return tracked and prev is None and len(self._path_last_ts) <= WINDOW_INFO_FILES
 
-    def _maybe_run(self):
+    def discard(self, path):
+        """File sparito nella stessa finestra in cui è comparso: create+delete si annullano."""
+        with self._lock:
+            if self._path_last_ts.pop(path, None) is None:
+                return False
+            self._open_paths.discard(path)
+            if not self._path_last_ts and not self._overflow:
+                # finestra vuota (solo file temporanei/rinominati): il run in attesa si annulla
+                self._first_event_ts = self._last_event_ts = self._wake_at = None
+            return True
+
+    def _scheduler_loop(self):
+        """
+        Unico thread per tutti i timer, su orologio monotonic: debounce (_wake_at, spostato in
+        avanti dagli eventi) + job periodici (pausa, log attività, rescan). Dorme fino alla
+        scadenza più vicina; ogni job si ripianifica da quando è scaduto, senza deriva.
+        """
+        activity_every = max(30, int(self.event_log_interval_seconds or 180))
+        rescan_every = max(1, int(self.rescan_minutes or 60)) * 60
+        now = time.monotonic()
+        jobs = [  # [prossima scadenza, intervallo, callback]
+            [now + self.pause_check, self.pause_check, self._refresh_pause],
+            [now + activity_every, activity_every, self._log_activity],
+            [now + rescan_every, rescan_every, self._rescan],
+        ]
+        while True:
+            with self._cv:
+                while True:
+                    now = time.monotonic()
+                    due = min(j[0] for j in jobs)
+                    if self._wake_at is not None:
+                        due = min(due, self._wake_at)
+                    if due <= now:
+                        break
+                    self._cv.wait(due - now)
+                debounce_due = self._wake_at is not None and self._wake_at <= now
+                if debounce_due:
+                    self._wake_at = None
+            if debounce_due and not self._call(self._maybe_run):
+                with self._lock:  # finestra ancora in attesa: si riprova dopo un debounce
+                    if self._wake_at is None and self._last_event_ts is not None:
+                        self._wake_at = time.monotonic() + self.debounce
+            for job in jobs:
+                if job[0] <= now:
+                    self._call(job[2])
+                    job[0] += job[1]
+                    if job[0] <= time.monotonic():  # callback lunga (upload): si riparte da ora
+                        job[0] = time.monotonic() + job[1]
+
+    def _call(self, cb):
+        # un'eccezione in un job non deve fermare l'unico thread dei timer: log e si prosegue
+        try:
+            cb()
+            return True
+        except Exception as e:
+            self.log.exception(f"Scheduler: errore in {cb.__name__}: {e}")
+            return False
+
+    def pause_state(self):
+        """(in pausa, scadenza): .auth_paused → (True, 0.0) fino a restart manuale; quota → (True, mtime)."""
         if PAUSE_FLAG.exists():
-            self.log.info("Pausa attiva (.auth_paused): salto esecuzione uploader.")
+            return True, 0.0
+        until = read_pause_until(self.pause_file) if self.pause_file else 0.0
+        return until > time.time(), until
+
+    def pause_active(self) -> bool:
+        return self.pause_state()[0]
+
+    def _pause_skip(self, what) -> bool:
+        """Un solo pause_state() per decisione: True (e log con la scadenza) se 'what' va saltato."""
+        paused, until = self.pause_state()
+        if paused:
+            when = f"quota fino a {time.strftime('%F %T', time.localtime(until))}" if until else "auth"
+            self.log.info(f"Pausa attiva ({when}): salto {what}.")
+        return paused
+
+    def _refresh_pause(self):
+        paused, until = self.pause_state()
+        if paused != self._paused:
+            if not paused:
+                msg = "Pausa terminata: eventi di nuovo accettati."
+            elif until:
+                msg = f"Pausa quota attiva fino a {time.strftime('%F %T', time.localtime(until))}."
+            else:
+                msg = "Pausa auth attiva (.auth_paused): serve un restart manuale."
+            self.log.info(msg)
+            syno_log_info(msg)
+        self._paused = paused
+
+    def _maybe_run(self):
+        if self._pause_skip("esecuzione uploader"):
             return
         with self._lock:
             if self._last_event_ts is None:
                 return
-            since_last = time.time() - self._last_event_ts
-            total_wait = time.time() - (self._first_event_ts or time.time())
-            if since_last >= self.settle or total_wait >= self.max_debounce:
-                self._run()
-                self._first_event_ts = None
-                self._last_event_ts = None
-            else:
-                self._timer = threading.Timer(self.debounce, self._maybe_run)
-                self._timer.daemon = True
-                self._timer.start()
+            now = time.monotonic()
+            since_last = now - self._last_event_ts
+            total_wait = now - (self._first_event_ts or now)
+            if self.close_events and self._open_paths and not self._overflow \
+                    and total_wait < self.max_debounce:
+                # file ancora aperti: il loro IN_CLOSE_WRITE risveglia il runner, altrimenti max_debounce
+                self._wake_at = self._first_event_ts + self.max_debounce
+                return
+            if not (since_last >= self.settle or total_wait >= self.max_debounce):
+                # un solo risveglio, esattamente quando settle o max_debounce scadono (nuovi eventi lo spostano)
+                self._wake_at = min(self._last_event_ts + self.settle,
+                                    (self._first_event_ts or now) + self.max_debounce)
+                return
+            changed = {p: ts for p, ts in self._path_last_ts.items() if p}
+            overflow, self._overflow = self._overflow, False
+            # reset prima del run (fuori dal lock): gli eventi durante l'upload aprono una nuova finestra
+            self._first_event_ts = None
+            self._last_event_ts = None
+            self._path_last_ts.clear()
+            self._open_paths.clear()
+        if changed:
+            # una riga per finestra di debounce in Log Center, non una per file
+            last = max(changed, key=changed.get)
+            n = f"oltre {len(changed)}" if overflow else f"{len(changed)}"
+            msg = f"{n} file cambiati nella finestra (ultimo: {os.path.basename(last)})"
+            self.log.info(msg)
+            syno_log_info(msg)
+        self._run()
 
     def _run(self):
-        if PAUSE_FLAG.exists():
-            self.log.info("Pausa attiva (.auth_paused): salto esecuzione uploader.")
-            return
-        msg = f"Esecuzione uploader: {' '.join(self.cmd)}"
-        self.log.info(msg)
-        syno_log_info(msg)
+        # pausa già verificata dal chiamante (_maybe_run, _rescan, scansione iniziale)
+        with self._lock:
+            if self._running:
+                self._pending = True
+                self.log.info("Uploader già in esecuzione: nuovo run accodato a fine esecuzione.")
+                return
+            self._running = True
+        # l'upload (minuti) gira in un thread suo: lo scheduler resta libero per pausa, log e debounce
+        threading.Thread(target=self._run_worker, daemon=True).start()
+
+    def _run_worker(self):
         try:
-            proc = subprocess.Popen(self.cmd)
-            code = proc.wait()
+            if uploader_is_running(self.uploader_pidfile):
+                self.log.info("Uploader già in esecuzione fuori dal watcher: run rimandato.")
+                with self._lock:
+                    self._pending = True
+                return
+            code = self._exec()
+            if code == EXIT_BUSY:
+                self.log.info("Uploader già in esecuzione (lock preso): run rimandato.")
+                with self._lock:
+                    self._pending = True
+                return
             msg2 = f"Uploader terminato con exit code {code}"
             self.log.info(msg2)
             syno_log_info(msg2)
         except Exception as e:
             self.log.exception(f"Errore esecuzione uploader: {e}")
             syno_log_err(f"Errore esecuzione uploader: {e}")
+        finally:
+            with self._lock:
+                self._running = False
+                rerun, self._pending = self._pending, False
+            # l'uploader può aver appena creato una pausa (auth/quota): stato in cache aggiornato subito,
+            # non al prossimo pause_check, così eventi e rerun non vengono accodati per niente
+            self._refresh_pause()
+            if rerun:
+                self.trigger()  # richieste arrivate durante il run → un solo run, dopo il debounce
 
-    def _rescan_loop(self):
-        while True:
-            mins = max(1, int(self.rescan_minutes or 60))
-            time.sleep(mins * 60)
-            if PAUSE_FLAG.exists():
-                self.log.info("Pausa attiva (.auth_paused): salto rescan periodico.")
-                continue
+    def start_daemon(self):
+        """Lancia l'uploader residente: interprete e import già caldi quando arriva il primo run."""
+        self._daemon = subprocess.Popen(self.cmd + ["--daemon"])
+        msg = f"Daemon uploader avviato (pid={self._daemon.pid})"
+        self.log.info(msg)
+        syno_log_info(msg)
+
+    def stop_daemon(self):
+        if self._daemon is not None and self._daemon.poll() is None:
+            self._daemon.terminate()
+            try:
+                self._daemon.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self._daemon.kill()
+
+    def _exec(self):
+        """Una scansione: richiesta al daemon uploader se in ascolto, altrimenti nuovo processo."""
+        if self._daemon is not None and self._daemon.poll() is not None:
+            # morto: lo si rilancia per i prossimi run, questo passa dal subprocess se non è ancora pronto
+            self.log.warning(f"Daemon uploader terminato (exit code {self._daemon.returncode}): lo rilancio.")
+            self.start_daemon()
+        if self.sock_path:
+            try:
+                if os.stat(self.sock_path).st_uid != os.getuid():
+                    raise PermissionError(f"{self.sock_path} non appartiene all'utente del watcher")
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as s:
+                    s.connect(self.sock_path)
+                    msg = f"Esecuzione uploader via daemon ({self.sock_path})"
+                    self.log.info(msg)
+                    syno_log_info(msg)
+                    s.sendall(b"scan\n")
+                    reply = s.makefile("rb").readline().decode("utf-8", "replace").strip()
+                code, _, detail = reply.partition(" ")
+                if detail:
+                    self.log.info(f"Daemon uploader: {detail}")
+                return int(code)
+            except (FileNotFoundError, ConnectionRefusedError):
+                pass  # daemon non avviato: normale, si usa il subprocess
+            except (OSError, ValueError) as e:
+                self.log.warning(f"Daemon uploader senza risposta valida ({e}): uso subprocess.")
+        msg = f"Esecuzione uploader: {self._cmd_str}"
+        self.log.info(msg)
+        syno_log_info(msg)
+        # posix_spawn (vfork+exec): niente copia delle page table del watcher, spawn rapido anche con poca RAM
+        pid = os.posix_spawn(self.cmd[0], self.cmd, os.environ)
+        _, status = os.waitpid(pid, 0)
+        return os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+
+    def _rescan(self):
+        # work_waiting() percorre tutte le sorgenti (anche minuti): in un thread suo come _run,
+        # lo scheduler resta libero per debounce e pausa; mai due rescan sovrapposti
+        with self._lock:
+            if self._rescanning:
+                return
+            self._rescanning = True
+        threading.Thread(target=self._rescan_worker, daemon=True).start()
+
+    def _rescan_worker(self):
+        try:
+            if self._pause_skip("rescan periodico"):
+                return
+            if self.work_waiting and not self.work_waiting():
+                self.log.info("Rescan periodico saltato: nessun file nuovo né upload da ritentare.")
+                return
             self.log.info("Rescan periodico: trigger massivo.")
             syno_log_info("Rescan periodico: trigger massivo.")
             self._run()
+        except Exception as e:
+            self.log.exception(f"Rescan periodico fallito: {e}")
+        finally:
+            with self._lock:
+                self._rescanning = False
 
-    def _activity_loop(self):
-        while True:
-            time.sleep(max(30, int(self.event_log_interval_seconds or 180)))
-            if self._last_event_ts:
-                ago = int(time.time() - self._last_event_ts)
-                msg = f"Eventi recenti: ultimo {ago}s fa; debounce={self.debounce}s, settle={self.settle}s."
-                self.log.info(msg)
-                syno_log_info(msg)
+    def _log_activity(self):
+        # snapshot coerente (timestamp + file in finestra) sotto lock: una volta ogni N secondi, costo nullo
+        with self._lock:
+            last = self._last_event_ts
+            files = sum(1 for p in self._path_last_ts if p)
+        if last is not None:
+            ago = int(time.monotonic() - last)
+            msg = (f"Eventi recenti: ultimo {ago}s fa, {files} file in attesa; "
+                   f"debounce={self.debounce}s, settle={self.settle}s.")
+            self.log.info(msg)
+            syno_log_info(msg)
 
 # ======= Watchdog handler =======
-class Handler(PatternMatchingEventHandler):
-    def __init__(self, logger, runner, patterns):
-        super().__init__(patterns=patterns, ignore_directories=True)
+class Handler(FileSystemEventHandler):
+    def __init__(self, logger, runner, exts):
+        super().__init__()
         self.log = logger
         self.runner = runner
-    def on_created(self, e): self._log("created", e.src_path); self.runner.trigger()
-    def on_moved(self, e):   self._log("moved", f"{e.src_path} -> {e.dest_path}"); self.runner.trigger()
-    def on_modified(self, e):self._log("modified", e.src_path); self.runner.trigger()
-    def _log(self, typ, path):
-        msg = f"{typ}: {path}"
-        self.log.info(msg)
-        syno_log_info(msg)
+        self.suffixes = tuple(sorted(exts))  # str.endswith(tuple): due chiamate C per evento, niente splitext
+        self._passed = {}  # path -> monotonic dell'ultimo evento inoltrato al runner
+    def _wanted(self, e, path):
+        return not e.is_directory and path.lower().endswith(self.suffixes)
+    def on_created(self, e):
+        if self._wanted(e, e.src_path):
+            self._event("created", e.src_path)
+    def on_moved(self, e):
+        # file rinominato/spostato dentro le sorgenti: già completo, conta come chiuso.
+        # src_path None = file entrato da fuori dalle sorgenti, solo inotify
+        if e.src_path and self._wanted(e, e.src_path):
+            self.runner.discard(e.src_path)
+        if self._wanted(e, e.dest_path):
+            if e.src_path:
+                self._event("moved", e.dest_path, f"{e.src_path} -> {e.dest_path}", closed=True)
+            else:
+                self._event("created", e.dest_path, closed=True)
+    def on_modified(self, e):
+        if self._wanted(e, e.src_path):
+            self._event("modified", e.src_path)
+    def on_closed(self, e):
+        # solo backend inotify (Linux/DSM): una volta per file alla chiusura, mai filtrato dal throttle
+        if self._wanted(e, e.src_path):
+            self._event("closed", e.src_path, closed=True)
+    def on_overflow(self):
+        # coda inotify piena: eventi persi, si programma comunque un run
+        self.log.warning("inotify: coda eventi piena, eventi persi → run programmato")
+        self.runner.trigger()
+    def on_deleted(self, e):
+        if self._wanted(e, e.src_path) and self.runner.discard(e.src_path):
+            self.log.debug(f"deleted: {e.src_path} (eventi precedenti scartati)")
+    def _event(self, typ, path, shown=None, closed=False):
+        # raffica create+modify×N sullo stesso file: al runner al massimo un evento ogni 200 ms.
+        # Throttle, non debounce: una copia lunga continua ad aggiornare il settle del runner.
+        now = time.monotonic()
+        if closed:
+            # dopo la chiusura la prossima scrittura (file riaperto) passa subito e lo rimarca aperto
+            self._passed.pop(path, None)
+        elif now - self._passed.get(path, 0.0) < 0.2:
+            return
+        else:
+            if len(self._passed) > 4096:
+                self._passed.clear()
+            self._passed[path] = now
+        msg = f"{typ}: {shown or path}"
+        # a INFO solo il primo evento dei primi file della finestra; Log Center riceve il conteggio al run
+        if self.runner.trigger(path, closed):
+            self.log.info(msg)
+        else:
+            self.log.debug(msg)
+
+# ======= Observer inotify nativo (Linux/DSM) =======
+IN_MODIFY, IN_CLOSE_WRITE, IN_MOVED_FROM, IN_MOVED_TO = 0x002, 0x008, 0x040, 0x080
+IN_CREATE, IN_DELETE, IN_IGNORED, IN_Q_OVERFLOW, IN_ISDIR = 0x100, 0x200, 0x8000, 0x4000, 0x40000000
+# IN_MODIFY serve: un file riaperto dopo IN_CLOSE_WRITE (o aperto prima della watch) torna "aperto";
+# la raffica di write() la assorbe il throttle dell'Handler
+IN_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+class InotifyObserver(threading.Thread):
+    """
+    inotify via ctypes al posto dell'Observer di watchdog: nessun buffer di ~0.5s per accoppiare
+    i move, solo gli eventi in IN_MASK, un select() bloccante senza timeout. Stessa interfaccia
+    usata da main() (schedule/start/stop/join/is_alive) e stessi callback on_* dell'Handler.
+    """
+    def __init__(self, logger):
+        super().__init__(name="inotify", daemon=True)
+        self.log = logger
+        libc = ctypes.CDLL(None, use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = (ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32)
+        self._fd = libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1")
+        self._stop_r, self._stop_w = os.pipe()
+        self._wd = {}      # wd -> [cartella, handler]
+        self._moves = {}   # cookie -> (wd, path) di un IN_MOVED_FROM in attesa del suo IN_MOVED_TO
+        self._full_warned = False
+
+    def schedule(self, handler, path, recursive=True):
+        self._watch_tree(path, handler)
+
+    def _watch_tree(self, root, handler, report=False):
+        # walk os.scandir: una watch per cartella; report=True → file già presenti (cartella entrata ora)
+        stack = [root]
+        while stack:
+            d = stack.pop()
+            wd = self._add_watch(self._fd, os.fsencode(d), IN_MASK)
+            if wd < 0:
+                err = ctypes.get_errno()
+                if err == errno.ENOSPC and not self._full_warned:
+                    self._full_warned = True
+                    w = "inotify: max_user_watches esaurito, alcune cartelle non sono osservate"
+                    self.log.warning(w)
+                    syno_log_warn(w)
+                continue
+            self._wd[wd] = [d, handler]
+            try:
+                with os.scandir(d) as it:
+                    for entry in it:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif report:
+                            # forse ancora in scrittura (cp -r, copia SMB): aperto fino al suo IN_CLOSE_WRITE
+                            handler.on_created(_FsEvent(entry.path))
+            except OSError:
+                continue
+
+    def stop(self):
+        os.write(self._stop_w, b"x")
+
+    def run(self):
+        while True:
+            ready, _, _ = select.select([self._fd, self._stop_r], [], [])
+            if self._stop_r in ready:
+                return
+            buf = os.read(self._fd, 64 * 1024)
+            i = 0
+            while i < len(buf):
+                wd, mask, cookie, ln = struct.unpack_from("iIII", buf, i)
+                name = os.fsdecode(buf[i + 16:i + 16 + ln].rstrip(b"\0"))
+                i += 16 + ln
+                try:
+                    self._dispatch(wd, mask, cookie, name)
+                except Exception as e:
+                    self.log.exception(f"inotify: errore gestione evento: {e}")
+
+    def _dispatch(self, wd, mask, cookie, name):
+        if mask & IN_Q_OVERFLOW:
+            # eventi persi: un run dell'uploader ricontrolla comunque tutte le sorgenti
+            for _, handler in list(self._wd.values())[:1]:
+                handler.on_overflow()
+            return
+        if mask & IN_IGNORED:
+            self._wd.pop(wd, None)
+            return
+        entry = self._wd.get(wd)
+        if entry is None:
+            return
+        d, handler = entry
+        path = os.path.join(d, name)
+        is_dir = bool(mask & IN_ISDIR)
+        if mask & IN_MOVED_FROM:
+            if len(self._moves) > 1024:  # move verso fuori dalle sorgenti: nessun IN_MOVED_TO arriverà
+                self._moves.clear()
+            self._moves[cookie] = path
+            if not is_dir:
+                handler.on_deleted(_FsEvent(path))  # uscito dalla finestra; se rientra arriva IN_MOVED_TO
+            return
+        if mask & IN_MOVED_TO:
+            src = self._moves.pop(cookie, None)
+            if is_dir:
+                if src is not None:
+                    # rename di cartella: le watch restano valide, si aggiornano i percorsi
+                    for e in self._wd.values():
+                        if e[0] == src or e[0].startswith(src + os.sep):
+                            e[0] = path + e[0][len(src):]
+                else:
+                    self._watch_tree(path, handler, report=True)
+            else:
+                handler.on_moved(_FsEvent(src, path))
+            return
+        if mask & IN_CREATE:
+            if is_dir:
+                self._watch_tree(path, handler, report=True)  # file copiati prima della watch
+            else:
+                handler.on_created(_FsEvent(path))
+        elif is_dir:
+            return
+        elif mask & IN_MODIFY:
+            handler.on_modified(_FsEvent(path))
+        elif mask & IN_CLOSE_WRITE:
+            handler.on_closed(_FsEvent(path))
+        elif mask & IN_DELETE:
+            handler.on_deleted(_FsEvent(path))
+
+class _FsEvent:
+    __slots__ = ("src_path", "dest_path", "is_directory")
+    def __init__(self, src_path, dest_path=None):
+        self.src_path = src_path
+        self.dest_path = dest_path
+        self.is_directory = False
 
 # ======= Config & patterns =======
 def read_config(cfg_path: Path) -> ConfigParser:
@@ -174,71 +677,182 @@ def read_config(cfg_path: Path) -> ConfigParser:
     cfg.read(cfg_path)
     return cfg
 
-def build_patterns_from_extensions(ext_list):
-    patterns = []
-    for e in ext_list:
-        e = e.strip()
-        if not e:
+def normalize_extensions(ext_list):
+    # suffissi minuscoli con il punto (".mp4"): confronto case-insensitive via lower().endswith()
+    return frozenset("." + e.strip().lower().lstrip(".") for e in ext_list if e.strip())
+
+def dedupe_roots(roots):
+    """
+    Percorsi canonici (~ espanso, symlink risolti), senza doppioni né cartelle già contenute in
+    un'altra root: una sola watch per cartella e nessun evento consegnato due volte.
+    """
+    kept = []
+    for r in sorted({os.path.realpath(os.path.expanduser(r)) for r in roots}, key=len):
+        if not any(r == k or r.startswith(k.rstrip(os.sep) + os.sep) for k in kept):
+            kept.append(r)
+    return kept
+
+def scan_state(cfg: ConfigParser):
+    """
+    Da state.db in sola lettura: (last_scan_started_at scritto dall'uploader a fine run,
+    ci sono upload non 'done' da ritentare?). (None, False) se assente/illeggibile.
+    Righe in errore/pending di file spariti non contano: l'uploader non le ritenterebbe mai.
+    """
+    db_path = Path(cfg.get("general", "db_path", fallback="/volume2/TubeSync/state.db")).expanduser()
+    try:
+        con = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+        try:
+            row = con.execute("SELECT value FROM meta WHERE key = 'last_scan_started_at'").fetchone()
+            # any() si ferma al primo file ancora presente; le righe non 'done' sono poche
+            pending = any(os.path.exists(r[0])
+                          for r in con.execute("SELECT path FROM uploads WHERE status != 'done'"))
+        finally:
+            con.close()
+        return (float(row[0]) if row else None), pending
+    except (sqlite3.Error, ValueError):
+        return None, False
+
+def has_files_newer_than(roots, exts, since: float, min_size: int = 0) -> bool:
+    """
+    Walk os.scandir delle sorgenti; si ferma al primo file video (>= min_size byte, come
+    skip_if_smaller_than_mb dell'uploader) modificato/copiato dopo 'since'. since=0 → qualsiasi.
+    """
+    suffixes = tuple(exts)
+    stack = [str(Path(r).expanduser()) for r in roots]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
             continue
-        if not e.startswith("."):
-            e = "." + e
-        base = e.lower()
-        patterns += [f"*{base}", f"*{base.upper()}"]
-        cap = base.capitalize()
-        if cap != base:
-            patterns.append(f"*{cap}")
-    return sorted(set(patterns))
+        with it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(suffixes) and entry.is_file():
+                        st = entry.stat()
+                        # ctime: una copia può preservare l'mtime originale (es. file della GoPro)
+                        if st.st_size >= min_size and max(st.st_mtime, st.st_ctime) > since:
+                            return True
+                except OSError:
+                    continue
+    return False
 
 # ======= Main =======
 def main():
     logger = setup_logging()
     cfg_path = Path(sys.argv[1]).expanduser() if len(sys.argv) > 1 else Path("/volume2/TubeSync/config.ini")
     cfg = read_config(cfg_path)
+    _syno.set_min_level(cfg)
 
     if not cfg.has_option("general", "source_dirs"):
         logger.error("source_dirs mancante in [general]")
         sys.exit(2)
-    roots = [s.strip() for s in cfg.get("general", "source_dirs").split(",") if s.strip()]
+    listed = [s.strip() for s in cfg.get("general", "source_dirs").split(",") if s.strip()]
+    roots = dedupe_roots(listed)
+    if len(roots) < len(listed):
+        logger.info(f"source_dirs: {len(listed) - len(roots)} cartelle duplicate o annidate ignorate")
 
     if not cfg.has_option("general", "allowed_extensions"):
         logger.error("allowed_extensions mancante in [general]")
         sys.exit(2)
     exts = [e.strip() for e in cfg.get("general", "allowed_extensions").split(",") if e.strip()]
-    patterns = build_patterns_from_extensions(exts)
-    logger.info(f"Estensioni monitorate: {patterns}")
-    syno_log_info(f"Watcher avviato. Estensioni: {patterns}")
+    exts = normalize_extensions(exts)
+    if not exts:
+        logger.error("allowed_extensions vuoto in [general]: nessun file da osservare")
+        sys.exit(2)
+    logger.info(f"Estensioni monitorate: {', '.join(sorted(exts))}")
+    syno_log_info(f"Watcher avviato. Estensioni: {', '.join(sorted(exts))}")
 
     debounce_seconds = cfg.getint("watcher", "debounce_seconds", fallback=90)
     settle_seconds = cfg.getint("watcher", "settle_seconds", fallback=60)
     max_debounce_seconds = cfg.getint("watcher", "max_debounce_seconds", fallback=900)
     rescan_minutes = cfg.getint("watcher", "rescan_minutes", fallback=60)
+    run_on_start = cfg.getboolean("watcher", "run_on_start", fallback=False)
+    uploader_daemon = cfg.getboolean("watcher", "uploader_daemon", fallback=False)
     event_log_interval_seconds = cfg.getint("watcher", "event_log_interval_seconds", fallback=180)
+    pause_check_seconds = cfg.getint("watcher", "pause_check_seconds", fallback=30)
+    # risolto una volta sola: nessun expanduser/abspath per evento
+    pause_file = Path(os.path.abspath(Path(cfg.get("general", "pause_file", fallback="/volume2/TubeSync/.pause_until")).expanduser()))
 
     cmd = ["/volume2/TubeSync/.venv/bin/python3", "/volume2/TubeSync/tubesync_synology.py", str(cfg_path)]
+    # socket del daemon solo se il watcher lo gestisce: altrimenti sempre processo separato
+    # cartella di state.db: lì l'uploader tiene .uploader.pid e (default) il socket del daemon
+    state_dir = Path(cfg.get("general", "db_path", fallback="/volume2/TubeSync/state.db")).expanduser().parent
+    sock_path = None
+    if uploader_daemon:
+        raw = cfg.get("general", "daemon_socket", fallback="").strip()
+        sock_path = str(Path(raw).expanduser() if raw else state_dir / ".uploader.sock")
+
+    min_size = max(0, cfg.getint("general", "skip_if_smaller_than_mb", fallback=5)) * 1024 * 1024
+
+    def work_waiting():
+        # upload in errore/pending da ritentare, o video più recenti dell'ultimo run completo
+        # (senza run registrati basta un video qualsiasi: sorgenti vuote → niente uploader)
+        since, pending = scan_state(cfg)
+        return pending or has_files_newer_than(roots, exts, since or 0.0, min_size)
 
     runner = DebouncedRunner(logger, cmd, debounce_seconds, settle_seconds, max_debounce_seconds,
-                             rescan_minutes, event_log_interval_seconds)
+                             rescan_minutes, event_log_interval_seconds, sock_path, pause_check_seconds,
+                             pause_file, work_waiting, state_dir / ".uploader.pid")
+    if sock_path:
+        runner.start_daemon()
+        atexit.register(runner.stop_daemon)
 
-    # Scansione iniziale
-    logger.info("Avvio watcher: scansione iniziale.")
-    syno_log_info("Scansione iniziale: lancio uploader")
+    # Linux/DSM: inotify nativo; altrove (o se non disponibile) l'Observer di watchdog
+    # polling: snapshot periodico delle sorgenti, nessuna watch inotify (alberi enormi)
+    observer = None
+    kind = cfg.get("watcher", "observer", fallback="auto").strip().lower()
+    if kind == "polling":
+        poll_seconds = max(5, cfg.getint("watcher", "poll_interval_seconds", fallback=60))
+        observer = PollingObserver(timeout=poll_seconds)
+        logger.info(f"Observer polling: snapshot ogni {poll_seconds}s")
+        # una copia in corso si vede solo a ogni snapshot (più il tempo del walk): con settle o debounce
+        # sotto l'intervallo la finestra si chiuderebbe tra due snapshot, a file ancora in scrittura
+        floor = 2 * poll_seconds
+        if runner.settle < floor or runner.debounce < floor:
+            w = (f"observer polling: settle/debounce portati ad almeno {floor}s "
+                 f"(2 × poll_interval_seconds = {poll_seconds}s)")
+            logger.warning(w)
+            syno_log_warn(w)
+            runner.settle, runner.debounce = max(runner.settle, floor), max(runner.debounce, floor)
+    elif kind in ("auto", "inotify") and sys.platform.startswith("linux"):
+        try:
+            observer = InotifyObserver(logger)
+            runner.close_events = True
+        except (OSError, AttributeError) as e:
+            logger.warning(f"inotify nativo non disponibile ({e}): uso watchdog")
+    if observer is None:
+        observer = Observer()
+
+    stop_msg = []
+    def _stop(signum, _frame):
+        # Ctrl-C / tubesync.sh stop: si ferma l'observer e main() esce da join(); atexit chiude il resto.
+        # Solo logging qui (lock rientranti): SynoLogger.lock può essere in mano al main thread
+        # interrotto dal segnale → Log Center scritto dopo join(), fuori dall'handler
+        stop_msg.append(f"Stop watcher (segnale {signal.Signals(signum).name})")
+        logger.info(stop_msg[-1])
+        if observer.is_alive():
+            observer.stop()
+        else:
+            sys.exit(0)  # ancora nella scansione iniziale
+    signal.signal(signal.SIGINT, _stop)
+    signal.signal(signal.SIGTERM, _stop)
 
-    if PAUSE_FLAG.exists():
-        logger.info("Pausa attiva (.auth_paused): salto scansione iniziale.")
-        syno_log_warn("Scansione iniziale SKIPPED per pausa auth")
+    # Scansione iniziale: solo se forzata o se c'è lavoro (vale anche per il rescan periodico)
+    if runner.pause_active():
+        logger.info("Pausa attiva (auth o quota): salto scansione iniziale.")
+        syno_log_warn("Scansione iniziale SKIPPED per pausa (auth o quota)")
+    elif not run_on_start and not work_waiting():
+        msg = "Scansione iniziale saltata: nessun file nuovo né upload da ritentare"
+        logger.info(msg)
+        syno_log_info(msg)
     else:
-        try:
-            logger.info(f"Esecuzione uploader: {' '.join(cmd)}")
-            syno_log_info(f"Esecuzione uploader: {' '.join(cmd)}")
-            proc = subprocess.Popen(cmd)
-            code = proc.wait()
-            logger.info(f"Uploader terminato con exit code {code}")
-            syno_log_info(f"Uploader terminato con exit code {code}")
-        except Exception as e:
-            logger.exception(f"Errore esecuzione uploader: {e}")
-            syno_log_err(f"Errore esecuzione uploader: {e}")
+        logger.info("Avvio watcher: scansione iniziale.")
+        syno_log_info("Scansione iniziale: lancio uploader")
+        runner._run()
 
-    observer = Observer()
     any_root = False
     for root in roots:
         p = Path(root).expanduser()
@@ -247,10 +861,17 @@ def main():
             logger.warning(w)
             syno_log_warn(w)
             continue
+        try:
+            observer.schedule(Handler(logger, runner, exts), str(p), recursive=True)
+        except OSError as e:
+            # watchdog: ENOSPC se le watch inotify del kernel sono finite
+            w = f"Impossibile osservare {p}: {e} (alza fs.inotify.max_user_watches)"
+            logger.warning(w)
+            syno_log_warn(w)
+            continue
         any_root = True
         logger.info(f"Osservo: {p}")
         syno_log_info(f"Osservo: {p}")
-        observer.schedule(Handler(logger, runner, patterns), str(p), recursive=True)
 
     if not any_root:
         e = "Nessuna root valida da osservare. Esco."
@@ -261,14 +882,9 @@ def main():
     observer.start()
     logger.info("TubeSync Watcher attivo. In attesa di eventi...")
     syno_log_info("TubeSync Watcher attivo. In attesa di eventi...")
-    try:
-        while True:
-            time.sleep(1)
-    except KeyboardInterrupt:
-        logger.info("Stop watcher (KeyboardInterrupt)")
-        syno_log_info("Stop watcher (KeyboardInterrupt)")
-        observer.stop()
-    observer.join()
+    observer.join()  # il main thread resta fermo qui, senza risvegli periodici, fino a _stop()
+    if stop_msg:
+        syno_log_info(stop_msg[0])
 
 if __name__ == "__main__":
     main()